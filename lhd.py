@@ -1,15 +1,30 @@
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
+from requests.adapters import HTTPAdapter
 from shapely.geometry import Point
 from tqdm.notebook import tqdm
+from urllib3.util import Retry
 import geopandas as gpd
 import json
+import numpy as np
 import pandas as pd
 import pdal
+import requests
+import shapely
+import shutil
 
 URL_LHD = "https://data.geopf.fr/private/wfs/wfs?apikey=interface_catalogue&SERVICE=WFS&REQUEST=GetFeature&VERSION=2.0.0&TYPENAMES=IGNF_LIDAR-HD_TA:nuage-dalle"
 
+# Only columns of the tile database used by LiDARHD
+DATABASE_COLUMNS = ["url", "bloc", "geometry"]
+
+# Shared HTTP session so WFS pages reuse the same keep-alive connections across threads
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32,
+                                      max_retries=Retry(total=3, backoff_factor=0.3,
+                                                        status_forcelist=(429, 500, 502, 503, 504))))
+
 
 class LiDARHD:
     def __init__(self, folder_path: str | Path = "./lidarhd_data/", overwrite: bool = False):
@@ -25,6 +40,10 @@ class LiDARHD:
         path = self._download_database(overwrite=overwrite)
         self.database_path = path
         self.database = self._read_database(path)
+        # Keep the tile geometries as a plain shapely array so lookups bypass the GeoSeries dispatch,
+        # along with their (minx, miny, maxx, maxy) bounds for a vectorized bbox pre-filter
+        self._geoms = np.asarray(self.database.geometry.values)
+        self._bounds = shapely.bounds(self._geoms)
 
     def _read_database(self, path: str | Path = None) -> gpd.GeoDataFrame:
         """
@@ -42,7 +61,11 @@ class LiDARHD:
             path = Path(path)
         if not path.exists():
             raise FileNotFoundError(f"Database file not found at: {path}")
-        return gpd.read_file(path).to_crs(2154)
+        gdf = gpd.read_parquet(path, columns=DATABASE_COLUMNS)
+        # Skip the reprojection when the database is already stored in CRS 2154
+        if gdf.crs is not None and gdf.crs.to_epsg() == 2154:
+            return gdf
+        return gdf.to_crs(2154)
 
     def _get_database_path(self) -> str | Path:
         """
@@ -51,7 +74,7 @@ class LiDARHD:
         Returns:
             str | Path: Path to the database file.
         """
-        files = list(self.folder_path.glob("LidarHD_tiles_database*.gpkg"))
+        files = list(self.folder_path.glob("LidarHD_tiles_database*.parquet"))
         if files:
             return files[0]
         else:
@@ -78,7 +101,7 @@ class LiDARHD:
         Args:
             overwrite (bool): Whether to overwrite the existing database.
             url (str): WFS service URL.
-            max_pages (int): Maximum number of pages to fetch. Defaults to 100.
+            max_pages (int): Maximum number of pages to fetch, fetching stops at the first empty page. Defaults to 100.
             ntiles (int): Number of tiles per page. Defaults to 5000.
             cpu_workers (int | float): Number of workers for parallel processing. Defaults to 12.
 
@@ -95,31 +118,68 @@ class LiDARHD:
         else:
             print("Downloading new database...")
 
-        # Fetch new database
-        start_indexes = [(n - 1) * ntiles for n in range(1, max_pages + 1)]
-        data_chunks = []
-
-        with ThreadPoolExecutor(max_workers=cpu_workers) as executor:
-            futures = {executor.submit(
-                fetch_chunk, url, ntiles, idx): idx for idx in start_indexes}
-            for future in tqdm(as_completed(futures), total=len(futures), desc="Fetching data chunks"):
-                result = future.result()
-                if result is not None:
-                    data_chunks.append(result)
-
-        if data_chunks:
-            db = pd.concat(data_chunks, ignore_index=True)
-            db['bloc'] = url2bloc(db['url'])
-            db = db.drop(
-                columns=['gml_id'], errors='ignore')
-
+        # The database is a GeoParquet dataset with one part per WFS page,
+        # so each page is written as soon as it arrives while the next ones are fetched.
+        # Parts go to a staging directory the database glob does not match, and replace
+        # the database only once every page is written, so an interrupted run leaves it untouched
         database_filename_path = self.folder_path / \
-            f"LidarHD_tiles_database_{datetime.today().strftime('%Y-%m-%d')}.gpkg"
-        db.to_file(database_filename_path, driver='GPKG')
+            f"LidarHD_tiles_database_{datetime.today().strftime('%Y-%m-%d')}.parquet"
+        staging_path = database_filename_path.with_name(database_filename_path.name + ".tmp")
+        # Clear staging directories left by interrupted runs, whatever their date
+        for stale_path in self.folder_path.glob("LidarHD_tiles_database*.parquet.tmp"):
+            remove_path(stale_path)
+        staging_path.mkdir()
+
+        # Fetch new database, one wave of pages at a time until the WFS runs out of tiles
+        wave_size = max(1, int(cpu_workers))
+        n_written = 0
+
+        try:
+            # Rate-limit progress updates, each one is a round-trip to the notebook widget
+            with ThreadPoolExecutor(max_workers=wave_size) as executor, \
+                    tqdm(total=max_pages, desc="Fetching data chunks", mininterval=0.5, smoothing=0) as pbar:
+                for first_page in range(0, max_pages, wave_size):
+                    pages = range(first_page, min(first_page + wave_size, max_pages))
+                    futures = {executor.submit(
+                        fetch_chunk, url, ntiles, n * ntiles): n for n in pages}
+                    exhausted = False
+                    for future in as_completed(futures):
+                        pbar.update(1)
+                        result = future.result()
+                        if result is None:
+                            exhausted = True
+                            continue
+                        result['bloc'] = url2bloc(result['url'])
+                        # Zero-padded names keep the dataset in WFS order when read back
+                        result[DATABASE_COLUMNS].to_parquet(
+                            staging_path / f"page_{futures[future]:05d}.parquet",
+                            compression="zstd", index=False)
+                        n_written += 1
+                    if exhausted:
+                        # Complete the progress bar on early stop
+                        pbar.total = pbar.n
+                        pbar.refresh()
+                        break
+        except BaseException:
+            shutil.rmtree(staging_path, ignore_errors=True)
+            raise
+
+        if n_written == 0:
+            shutil.rmtree(staging_path)
+            raise ValueError(f"No tiles could be fetched from the WFS service: {url}")
+
+        # Swap the complete dataset in place of the previous database, then drop databases from other dates
+        if database_filename_path.exists():
+            remove_path(database_filename_path)
+        staging_path.rename(database_filename_path)
+        for old_path in self.folder_path.glob("LidarHD_tiles_database*.parquet"):
+            if old_path != database_filename_path:
+                remove_path(old_path)
+
         print(f"LiDARHD Database saved in: {database_filename_path}")
-        return self._get_database_path()
+        return database_filename_path
 
-    def _get_clouds_intersecting(self, gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    def _get_clouds_intersecting(self, gdf: gpd.GeoDataFrame) -> tuple[gpd.GeoDataFrame, shapely.Geometry | None]:
         """
         Get the LiDAR-HD tiles intersecting a given GeoDataFrame.
 
@@ -127,41 +187,64 @@ class LiDARHD:
             gdf (gpd.GeoDataFrame): GeoDataFrame containing geometries to check against LiDAR-HD tiles.
 
         Returns:
-            gpd.GeoDataFrame: GeoDataFrame containing the intersecting tiles.
+            tuple[gpd.GeoDataFrame, shapely.Geometry | None]: GeoDataFrame containing the intersecting tiles,
+                and the union of the input geometries in CRS 2154 (None if the GeoDataFrame has no geometry).
         """
         if self.database is None:
             raise ValueError(
                 "Database is not loaded. Call `get_database` first.")
 
+        # Nothing to look up for an empty or all-null AOI
+        if gdf.empty or gdf.geometry.isna().all():
+            return self.database.iloc[0:0], None
+
         # Convert to CRS 2154
         gdf = gdf.to_crs(2154)
-        union_all = gdf.union_all()
+        if len(gdf) == 1 and gdf.geometry.iloc[0].geom_type == "Point":
+            # A single point is its own union and has no edges worth preparing
+            aoi = gdf.geometry.iloc[0]
+        else:
+            aoi = gdf.union_all()
+            # Prepare once so the exact intersects tests reuse the same edge index
+            shapely.prepare(aoi)
 
-        print(f"Input area is {union_all.area/ 1e6 : .3f} km²")
+        print(f"Input area is {aoi.area/ 1e6 : .3f} km²")
 
-        intersecting_tiles = self.database[self.database.intersects(union_all)]
+        # Bbox overlap on the cached tile bounds, then exact test on the candidates only
+        minx, miny, maxx, maxy = aoi.bounds
+        candidates = np.flatnonzero(
+            (self._bounds[:, 0] <= maxx) & (self._bounds[:, 2] >= minx) &
+            (self._bounds[:, 1] <= maxy) & (self._bounds[:, 3] >= miny))
+        # The prepared AOI goes first, shapely only uses a prepared geometry as the first argument
+        idx = candidates[shapely.intersects(aoi, self._geoms[candidates])]
+        intersecting_tiles = self.database.iloc[idx]
 
-        return intersecting_tiles
+        return intersecting_tiles, aoi
 
-    def download(self, gdf: gpd.GeoDataFrame, download_path: str) -> pd.DataFrame:
+    def download(self, gdf: gpd.GeoDataFrame, download_path: str, cpu_workers: int = 12,
+                 return_dataframe: bool = True) -> pd.DataFrame | None:
         """
         Download LiDAR points for the tiles intersecting the provided GeoDataFrame.
         This method checks which LiDAR-HD tiles intersect with the geometries in the provided GeoDataFrame,
         and downloads the corresponding LiDAR data to the specified path in LAZ format.
-        It uses PDAL to handle the downloading and processing of the LiDAR data.
+        It uses PDAL to handle the downloading and processing of the LiDAR data, reading the tiles in parallel,
+        or streaming them through a single pipeline in bounded memory when return_dataframe is False.
         If no intersecting tiles are found, it raises a ValueError.
 
         Args:
             gdf (gpd.GeoDataFrame): GeoDataFrame containing geometries to check against LiDAR-HD tiles.
             download_path (str): Path to save the downloaded LiDAR data as LAZ file.
+            cpu_workers (int): Number of tiles read in parallel, unused when streaming. Defaults to 12.
+            return_dataframe (bool): Whether to return the points as a DataFrame. Set to False for large areas
+                to stream the points to the LAZ file without holding the cloud in memory. Defaults to True.
         Returns:
-            pd.DataFrame: DataFrame containing the downloaded LiDAR points.
+            pd.DataFrame | None: DataFrame containing the downloaded LiDAR points, None if return_dataframe is False.
         """
         if not download_path.endswith('.laz'):
             raise ValueError(
                 "Download path must end with '.laz' to indicate a compressed LAS file.")
 
-        intersecting_tiles = self._get_clouds_intersecting(gdf)
+        intersecting_tiles, aoi = self._get_clouds_intersecting(gdf)
         if intersecting_tiles.empty:
             raise ValueError(
                 "No intersecting tiles found for the provided GeoDataFrame.")
@@ -172,33 +255,50 @@ class LiDARHD:
 
         # return
 
-        # Create a PDAL pipeline with multiple readers if needed
-        pipeline = {
-            "pipeline": []
-        }
-        for url in download_urls:
-            pipeline["pipeline"].append({
-                "type": "readers.copc",
-                "filename": url,
-                "polygon": gdf.union_all().wkt  # Use the union of all geometries in the GeoDataFrame
-            })
-
-        # Add a merge step if multiple readers are used
-        if len(download_urls) > 1:
-            pipeline["pipeline"].append({
-                "type": "filters.merge"
-            })
-
-        # Add the writer to the pipeline
-        pipeline["pipeline"].append({
+        # Readers only prune COPC nodes with their tile bbox clamped to the AOI bbox,
+        # the polygon is applied once after merging
+        aoi_bounds = np.asarray(aoi.bounds)
+        clip_bounds = shapely.bounds(np.asarray(intersecting_tiles.geometry.values))
+        clip_bounds[:, :2] = np.maximum(clip_bounds[:, :2], aoi_bounds[:2])
+        clip_bounds[:, 2:] = np.minimum(clip_bounds[:, 2:], aoi_bounds[2:])
+        tile_bounds = [f"([{minx}, {maxx}], [{miny}, {maxy}])" for minx, miny, maxx, maxy in clip_bounds]
+
+        # Crop to the AOI once, after all the tiles, and write to a compressed LAS file
+        output_stages = [{
+            "type": "filters.crop",
+            "polygon": aoi.wkt
+        }, {
             "type": "writers.las",
             "filename": download_path,
             "compression": "true"
-        })
+        }]
+
+        if not return_dataframe:
+            # Stream every tile through a single pipeline, only one chunk of points is held in memory
+            readers = [{
+                "type": "readers.copc",
+                "filename": url,
+                "bounds": bounds
+            } for url, bounds in zip(download_urls, tile_bounds)]
+            pdal_pipeline = pdal.Pipeline(json.dumps({"pipeline": readers + output_stages}))
+            n_points = pdal_pipeline.execute_streaming(chunk_size=1_000_000)
+            print(f"Downloaded LiDAR data to: {download_path}")
+            print(f"Number of points downloaded: {n_points}")
+            return None
+
+        # Read each tile in its own PDAL pipeline, in parallel
+        # map keeps the tile order, and no Future outlives the loop holding on to a tile array
+        with ThreadPoolExecutor(max_workers=cpu_workers) as executor:
+            tile_arrays = list(tqdm(executor.map(read_tile, download_urls, tile_bounds),
+                                    total=len(download_urls), desc="Reading clouds"))
 
-        # Create a PDAL pipeline object
-        pdal_pipeline = pdal.Pipeline(json.dumps(pipeline))
-        # Execute the pipeline
+        # Merge the tiles in PDAL, which accepts tiles with different dimensions
+        pipeline = {
+            "pipeline": [{
+                "type": "filters.merge"
+            }] + output_stages
+        }
+        pdal_pipeline = pdal.Pipeline(json.dumps(pipeline), arrays=tile_arrays)
         pdal_pipeline.execute()
         print(f"Downloaded LiDAR data to: {download_path}")
         df_points = pdal_pipeline.get_dataframe(idx=0)
@@ -207,15 +307,35 @@ class LiDARHD:
 
 
 # Helper functions
-def fetch_chunk(url: str, ntiles: int, start_index: int) -> gpd.GeoDataFrame:
-    try:
-        params = f"&STARTINDEX={start_index}&COUNT={ntiles}&SRSNAME=urn:ogc:def:crs:EPSG::2154"
-        full_url = url + params
-        gdf = gpd.read_file(full_url)
-        return gdf if not gdf.empty else None
-    except Exception:
-        return None
+def fetch_chunk(url: str, ntiles: int, start_index: int) -> gpd.GeoDataFrame | None:
+    # Only an empty page returns None, request errors are raised so a failed page never looks like the end of data
+    params = f"&STARTINDEX={start_index}&COUNT={ntiles}&SRSNAME=urn:ogc:def:crs:EPSG::2154&OUTPUTFORMAT=application/json"
+    full_url = url + params
+    response = SESSION.get(full_url, timeout=60)
+    response.raise_for_status()
+    features = response.json()["features"]
+    return gpd.GeoDataFrame.from_features(features, crs=2154) if features else None
+
+
+def read_tile(url: str, bounds: str) -> np.ndarray:
+    pipeline = {
+        "pipeline": [{
+            "type": "readers.copc",
+            "filename": url,
+            "bounds": bounds
+        }]
+    }
+    pdal_pipeline = pdal.Pipeline(json.dumps(pipeline))
+    pdal_pipeline.execute()
+    return pdal_pipeline.arrays[0]
+
+
+def remove_path(path: Path) -> None:
+    if path.is_dir():
+        shutil.rmtree(path)
+    else:
+        path.unlink()
 
 
 def url2bloc(url_series: pd.Series) -> pd.Series:
-    return url_series.apply(lambda x: x.split("/")[-1].split(".")[0] if isinstance(x, str) else None)
+    return url_series.str.rsplit("/", n=1).str[-1].str.split(".", n=1).str[0]